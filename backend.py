@@ -0,0 +1,407 @@
+import streamlit as st
+from collections import Counter, defaultdict
+from zoneinfo import ZoneInfo
+import os
+import re
+import time
+import logging
+import atexit
+import random
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from pathlib import Path
+from threading import Lock, Thread
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# --- CONFIGURATION ---
+SCOPES = [
+    "https://www.googleapis.com/auth/spreadsheets",
+    "https://www.googleapis.com/auth/drive"
+]
+
+DHAKA_TZ = ZoneInfo('Asia/Dhaka')
+SHEET_TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+FILE_TIME_FORMAT = "%Y%m%d_%H%M%S"
+
+FLUSH_EVERY = 10
+FLUSH_INTERVAL = 30
+
+RETRY_STATUSES = (429, 500, 503)
+
+# Recordings are spooled here as <split>/<dataset>/<region>/<file> and uploaded in batches
+PENDING_DIR = Path("_pending")
+UPLOAD_EVERY = 10
+UPLOAD_INTERVAL = 60
+UPLOAD_POLL = 5
+
+_upload_lock = Lock()
+
+@st.cache_resource
+def get_google_creds():
+    # Parse the service-account key once per process
+    from oauth2client.service_account import ServiceAccountCredentials
+    if "gcp_service_account" in st.secrets:
+        return ServiceAccountCredentials.from_json_keyfile_dict(
+            dict(st.secrets["gcp_service_account"]), SCOPES
+        )
+    else:
+        return ServiceAccountCredentials.from_json_keyfile_name("secrets.json", SCOPES)
+
+@st.cache_resource
+def get_http_adapter():
+    # Keep-alive connection pool shared by gspread and HfApi, so only the first call pays the TLS handshake
+    return HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=Retry(total=3, backoff_factor=0.3))
+
+def _pooled_session():
+    session = requests.Session()
+    session.mount("https://", get_http_adapter())
+    return session
+
+def with_retry(fn, *args, tries=4, base=0.3, **kwargs):
+    # Retries quota (429) and transient server errors from Sheets with exponential backoff + jitter
+    from gspread.exceptions import APIError
+    for attempt in range(tries):
+        try:
+            return fn(*args, **kwargs)
+        except APIError as e:
+            if e.response.status_code not in RETRY_STATUSES or attempt == tries - 1:
+                raise
+            time.sleep(base * 2 ** attempt + random.random() * 0.1)
+
+@st.cache_resource
+def get_spreadsheet():
+    # Authorize and open once per process instead of on every call
+    import gspread
+    client = gspread.authorize(get_google_creds())
+    client.http_client.session.mount("https://", get_http_adapter())
+    return with_retry(client.open, "Dialect_Database")
+
+@st.cache_resource
+def get_sentence_sheet():
+    # .sheet1 fetches the spreadsheet metadata, so it is a Sheets call like the others
+    return with_retry(lambda: get_spreadsheet().sheet1)
+
+@st.cache_resource
+def get_users_sheet():
+    return with_retry(get_spreadsheet().worksheet, "User_Stats")
+
+# --- BACKEND LOGIC ---
+
+@st.cache_data(ttl=300, show_spinner=False)
+def _load_tables():
+    # Raw values of the sentence sheet and User_Stats in one values_batch_get round-trip;
+    # refreshed every five minutes or after a flush
+    from gspread.utils import absolute_range_name
+    sheets = (get_sentence_sheet(), get_users_sheet())
+    # UNFORMATTED_VALUE so counts arrive as numbers rather than display strings like "1,000"
+    response = with_retry(
+        get_spreadsheet().values_batch_get,
+        [absolute_range_name(ws.title) for ws in sheets],
+        params={"valueRenderOption": "UNFORMATTED_VALUE"},
+    )
+    return [value_range.get("values", []) for value_range in response["valueRanges"]]
+
+def _to_int(value):
+    # Counts arrive as JSON numbers, but hand-edited cells can still hold text or be blank
+    try:
+        return int(float(str(value).replace(",", "")))
+    except ValueError:
+        return 0
+
+# The indexes below are built once per snapshot and shared as-is: cache_data would unpickle a
+# fresh copy on every call, which costs more than the lookups it serves. Treat them as read-only.
+@st.cache_resource(ttl=300, show_spinner=False)
+def _sentence_index():
+    # global_id -> record and global_id -> sheet row for O(1) lookups without a server-side find(),
+    # plus (region, split) -> ids still below target, so picking a sentence doesn't rebuild the mask.
+    # Unflushed recordings are layered on top via get_next_sentence's pending_counts.
+    # The API drops trailing empty cells, so short rows are padded before zipping with the header.
+    header, *rows = _load_tables()[0]
+    records_by_id = {}
+    rows_by_id = {}
+    pending_ids = defaultdict(list)
+    for i, row in enumerate(rows):
+        r = dict(zip(header, row + [''] * (len(header) - len(row))))
+        r['recording_count'] = _to_int(r['recording_count'])
+        r['target_count'] = _to_int(r['target_count'])
+        global_id = str(r['global_id'])
+        records_by_id[global_id] = r
+        rows_by_id[global_id] = i + 2
+        if r['recording_count'] < r['target_count']:
+            pending_ids[(r['region'], r['split'])].append(global_id)
+    return records_by_id, rows_by_id, dict(pending_ids)
+
+@st.cache_resource(ttl=300, show_spinner=False)
+def _load_user_rows():
+    # user_id -> (sheet row, recording count), shared by all sessions.
+    # Counts only change through this app, which clears the cache on every flush, so a long TTL is safe.
+    values = _load_tables()[1]
+    return {
+        str(row[0]): (i + 2, _to_int(row[1]) if len(row) > 1 else 0)
+        for i, row in enumerate(values[1:]) if row
+    }
+
+def _clear_sheet_cache():
+    _load_tables.clear()
+    _sentence_index.clear()
+    _load_user_rows.clear()
+
+def get_next_sentence(region, pending_counts=None):
+    # pending_counts: recordings per global_id that are not in the sheet yet
+    pending_counts = pending_counts or {}
+    records_by_id, _, pending_ids = _sentence_index()
+
+    # Queued recordings may already have filled some sentences up to their target
+    filled = {
+        global_id for global_id, added in pending_counts.items()
+        if global_id in records_by_id
+        and records_by_id[global_id]['recording_count'] + added >= records_by_id[global_id]['target_count']
+    }
+
+    # Priority 1: Test, Priority 2: Train
+    for split in ('test', 'train'):
+        ids = pending_ids.get((region, split), [])
+        if filled:
+            ids = [global_id for global_id in ids if global_id not in filled]
+        if ids:
+            # A copy, so callers can't mutate the shared index
+            return dict(records_by_id[random.choice(ids)])
+        
+    return None
+
+def get_user_stats(user_id):
+    from gspread.exceptions import APIError
+    try:
+        return _load_user_rows().get(user_id, (None, 0))[1]
+    except APIError:
+        # Only the progress bar depends on this, so fall back to 0 once retries are exhausted
+        return 0
+
+def update_global_and_user_stats(sentence_adds, user_adds, last_seen):
+    # sentence_adds / user_adds: recordings per global_id / user_id since the last flush.
+    # Returns the users not in User_Stats yet; add_new_users appends them separately.
+    from gspread.utils import absolute_range_name
+    sheet_data = get_sentence_sheet()
+    sheet_users = get_users_sheet()
+    records_by_id, sentence_rows, _ = _sentence_index()
+    users = _load_user_rows()
+
+    # 1. Update Global: rows and counts come from the cached snapshot instead of find + cell
+    data = []
+    for global_id, added in sentence_adds.items():
+        if global_id not in records_by_id:
+            # Row deleted or its ID edited since it was served; drop it rather than block the batch
+            logger.warning("Dropping %d recording(s) for unknown global_id %s", added, global_id)
+            continue
+        row_s = sentence_rows[global_id]
+        current_s_val = records_by_id[global_id]['recording_count']
+        data.append({"range": absolute_range_name(sheet_data.title, f"F{row_s}"), "values": [[current_s_val + added]]})
+
+    # 2. Update User (With DHAKA Time)
+    new_users = Counter()
+    for user_id, added in user_adds.items():
+        if user_id in users:
+            row_u, current_u_val = users[user_id]
+            data.append({
+                "range": absolute_range_name(sheet_users.title, f"B{row_u}:C{row_u}"),
+                "values": [[current_u_val + added, last_seen[user_id]]],
+            })
+        else:
+            new_users[user_id] = added
+
+    # USER_ENTERED (like update_cell) so the last-seen column holds real dates, not text.
+    # These writes set absolute values, so retrying them after a 5xx is safe.
+    if data:
+        with_retry(
+            get_spreadsheet().values_batch_update,
+            body={"valueInputOption": "USER_ENTERED", "data": data},
+        )
+
+    # Counts changed, so the cached snapshots are stale
+    _clear_sheet_cache()
+    return new_users
+
+def add_new_users(new_users, last_seen):
+    # Appends are not idempotent: a 5xx after the server applied them would duplicate
+    # the user's row on retry, so new users go out in their own, single-attempt request
+    # The leading ' keeps USER_ENTERED from turning the id into a number or formula
+    rows = [[f"'{user_id}", added, last_seen[user_id]] for user_id, added in new_users.items()]
+    try:
+        get_users_sheet().append_rows(rows, value_input_option="USER_ENTERED")
+    finally:
+        # Even a failed append may have landed; a fresh snapshot turns the retry into an update
+        _clear_sheet_cache()
+
+@st.cache_resource
+def get_pending_writes():
+    # Process-wide increments not yet written to Sheets, shared by every session so one
+    # flush covers all volunteers; flushed on exit so a clean shutdown loses nothing
+    pending = {
+        "lock": Lock(),
+        "flush_lock": Lock(),
+        "sentences": Counter(),
+        "users": Counter(),
+        "last_seen": {},
+        "since": None,
+        "in_flight": Counter(),
+    }
+    atexit.register(_flush, pending, True)
+    return pending
+
+def queue_submission(global_id, user_id, current_time):
+    pending = get_pending_writes()
+    with pending["lock"]:
+        if pending["since"] is None:
+            pending["since"] = time.monotonic()
+        pending["sentences"][global_id] += 1
+        pending["users"][user_id] += 1
+        pending["last_seen"][user_id] = current_time
+
+def pending_sentence_counts():
+    # Includes the batch currently being written, which the cached snapshot doesn't show yet
+    pending = get_pending_writes()
+    with pending["lock"]:
+        return pending["sentences"] + pending["in_flight"]
+
+def _requeue(pending, sentences, users, last_seen, since):
+    # Merge unwritten increments back so the next flush retries them; newer last-seen times win
+    with pending["lock"]:
+        pending["sentences"].update(sentences)
+        pending["users"].update(users)
+        for user_id, current_time in last_seen.items():
+            pending["last_seen"].setdefault(user_id, current_time)
+        pending["since"] = since if pending["since"] is None else min(since, pending["since"])
+
+def _flush(pending, force):
+    # One flush writes at a time, since each computes totals from the snapshot the previous one
+    # refreshed; a non-forced flush just skips if another one is already running
+    if not pending["flush_lock"].acquire(blocking=force):
+        return
+    try:
+        # Swap the counters out under the lock and write outside it, so queue_submission and
+        # pending_sentence_counts never wait on the network
+        with pending["lock"]:
+            if not (pending["sentences"] or pending["users"]):
+                return
+            due = (
+                sum(pending["sentences"].values()) >= FLUSH_EVERY
+                or time.monotonic() - pending["since"] >= FLUSH_INTERVAL
+            )
+            if not (force or due):
+                return
+            sentences, users, last_seen, since = (
+                pending["sentences"], pending["users"], pending["last_seen"], pending["since"]
+            )
+            pending.update(sentences=Counter(), users=Counter(), last_seen={}, since=None, in_flight=sentences)
+
+        try:
+            new_users = update_global_and_user_stats(sentences, users, last_seen)
+        except Exception:
+            _requeue(pending, sentences, users, last_seen, since)
+            raise
+        finally:
+            with pending["lock"]:
+                pending["in_flight"] = Counter()
+
+        # Sentence and existing-user counts are written now, so only the append can be retried.
+        # A re-queued user whose append did land shows up as existing in the fresh snapshot.
+        if new_users:
+            try:
+                add_new_users(new_users, last_seen)
+            except Exception:
+                _requeue(pending, Counter(), new_users, {u: last_seen[u] for u in new_users}, since)
+                raise
+    finally:
+        pending["flush_lock"].release()
+
+def flush_pending_writes(force=False):
+    # Sheets writes are sent every FLUSH_EVERY submissions or FLUSH_INTERVAL seconds
+    _flush(get_pending_writes(), force)
+
+@st.cache_resource
+def get_hf_api():
+    # create_repo is idempotent, so it only needs to run once per process
+    os.environ.setdefault("HF_XET_HIGH_PERFORMANCE", "1")
+    from huggingface_hub import HfApi, configure_http_backend
+    # requests-based hook; huggingface_hub 1.x replaced it, hence the <1.0 pin in requirements.txt
+    configure_http_backend(backend_factory=_pooled_session)
+    api = HfApi(token=st.secrets["HF_TOKEN"])
+    api.create_repo(repo_id=st.secrets["HF_REPO"], repo_type="dataset", exist_ok=True)
+    return api
+
+def safe_path_part(value):
+    # URL parameters end up in spool paths and repo paths, so keep them to one plain segment
+    return re.sub(r"[^\w.-]+", "_", str(value)).strip(".") or "_"
+
+def _spooled_recordings():
+    # Only finished files; in-progress writes still carry the .part suffix
+    return sorted(PENDING_DIR.rglob("*.wav"))
+
+def upload_pending_recordings():
+    # One commit listing every spooled recording explicitly, then drop exactly those local copies
+    from huggingface_hub import CommitOperationAdd
+    with _upload_lock:
+        files = _spooled_recordings()
+        if not files:
+            return
+        operations = [
+            CommitOperationAdd(path_in_repo=f.relative_to(PENDING_DIR).as_posix(), path_or_fileobj=str(f))
+            for f in files
+        ]
+        get_hf_api().create_commit(
+            repo_id=st.secrets["HF_REPO"],
+            repo_type="dataset",
+            operations=operations,
+            commit_message=f"Add {len(files)} recordings",
+        )
+        for f in files:
+            f.unlink()
+
+def _upload_loop():
+    while True:
+        time.sleep(UPLOAD_POLL)
+        # Any failure, including a file vanishing between listing and stat, must not end the thread;
+        # files stay on disk and go out with the next batch
+        try:
+            files = _spooled_recordings()
+            if not files:
+                continue
+            oldest = min(f.stat().st_mtime for f in files)
+            if len(files) >= UPLOAD_EVERY or time.time() - oldest >= UPLOAD_INTERVAL:
+                upload_pending_recordings()
+        except Exception:
+            logger.exception("Batch upload failed")
+
+@st.cache_resource
+def get_uploader():
+    # Background thread that batches spooled recordings into one HF commit
+    thread = Thread(target=_upload_loop, daemon=True)
+    thread.start()
+    atexit.register(upload_pending_recordings)
+    return thread
+
+def save_recording(audio_file, filename, dataset_source, split, region):
+    try:
+        get_uploader()
+        parts = [safe_path_part(p) for p in (split, dataset_source, region, filename)]
+        path = PENDING_DIR.joinpath(*parts)
+        if not path.resolve().is_relative_to(PENDING_DIR.resolve()):
+            raise ValueError(f"Refusing to write outside {PENDING_DIR}: {path}")
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        # Write under a temporary name so the uploader never picks up a partial file
+        part = path.with_name(path.name + ".part")
+        part.write_bytes(audio_file.getbuffer())
+        os.replace(part, path)
+        return True
+    except Exception as e:
+        st.error(f"Saving failed: {e}")
+        return False
+
+@st.cache_resource
+def get_executor():
+    # Shared worker pool for I/O that can overlap with saving a recording
+    return ThreadPoolExecutor(max_workers=4)
@@ -1,11 +1,11 @@
 from selenium import webdriver
 from selenium.webdriver.chrome.options import Options
+from selenium.webdriver.chrome.service import Service
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.common.exceptions import TimeoutException
 import os
-import time
 
 # Get URL from GitHub Secrets or fall back to your hardcoded link
 STREAMLIT_URL = os.environ.get("STREAMLIT_APP_URL", "https://dialect-app.streamlit.app")
@@ -18,9 +18,14 @@ def main():
     options.add_argument('--headless=new')
     options.add_argument('--no-sandbox')
     options.add_argument('--disable-dev-shm-usage')
-    options.add_argument('--disable-gpu')
-    
-    driver = webdriver.Chrome(options=options)
+    # Return once the DOM is interactive instead of waiting for every asset
+    options.page_load_strategy = 'eager'
+
+    # GitHub runners ship a matching chromedriver; use it to skip Selenium Manager's driver lookup
+    driver_dir = os.environ.get("CHROMEWEBDRIVER")
+    service = Service(os.path.join(driver_dir, "chromedriver")) if driver_dir else Service()
+
+    driver = webdriver.Chrome(service=service, options=options)
 
     try:
         driver.get(STREAMLIT_URL)
@@ -37,9 +42,12 @@ def main():
             print("💤 App is sleeping. Clicking wake button...")
             button.click()
             
-            # Wait to ensure the click registered
-            time.sleep(5)
-            print("✅ Wake button clicked. App should be rebooting.")
+            # Wait until the wake button is gone, i.e. the click registered
+            try:
+                wait.until(EC.staleness_of(button))
+                print("✅ Wake button clicked. App should be rebooting.")
+            except TimeoutException:
+                print("⚠️ Wake button clicked, but the page did not change yet.")
 
         except TimeoutException:
             print("✨ No wake button found. The app is likely already awake!")